@@ -0,0 +1,126 @@
+import os
+import json
+import cart_service_pb2
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+def cart_items(cart):
+    return [cart_service_pb2.CartItem(product_id=item["product_id"], quantity=item["quantity"])
+            for item in cart.get("items", [])]
+
+
+class JsonCodec:
+    """Original encoding, kept on the unversioned keys"""
+
+    name = "json"
+    version = None
+
+    def encode_product(self, product):
+        return json.dumps(product)
+
+    def decode_product(self, data):
+        return json.loads(data)
+
+    def encode_cart(self, cart):
+        return json.dumps(cart)
+
+    def decode_cart(self, data):
+        return json.loads(data)
+
+    def decode_cart_items(self, data):
+        return cart_items(self.decode_cart(data))
+
+
+class ProtobufCodec:
+    """Serialized CachedProduct / CachedCart messages"""
+
+    name = "protobuf"
+    version = "pb1"
+
+    def encode_product(self, product):
+        return cart_service_pb2.CachedProduct(
+            id=product["_id"],
+            name=product.get("name", ""),
+            price=product["price"],
+            stock=product["stock"],
+        ).SerializeToString()
+
+    def decode_product(self, data):
+        message = cart_service_pb2.CachedProduct.FromString(data)
+        return {"_id": message.id, "name": message.name, "price": message.price, "stock": message.stock}
+
+    def encode_cart(self, cart):
+        return cart_service_pb2.CachedCart(
+            id=cart["_id"],
+            user_id=cart["user_id"],
+            items=cart_items(cart),
+        ).SerializeToString()
+
+    def decode_cart_items(self, data):
+        """Parsed CartItem messages, ready for GetCartItemsResponse"""
+        return cart_service_pb2.CachedCart.FromString(data).items
+
+    def decode_cart(self, data):
+        message = cart_service_pb2.CachedCart.FromString(data)
+        return {
+            "_id": message.id,
+            "user_id": message.user_id,
+            "items": [{"product_id": item.product_id, "quantity": item.quantity} for item in message.items],
+        }
+
+
+class MsgpackCodec:
+    """Full documents packed with msgpack"""
+
+    name = "msgpack"
+    version = "mp1"
+
+    def __init__(self):
+        if msgpack is None:
+            raise RuntimeError("CACHE_CODEC=msgpack requires the msgpack package")
+
+    def encode_product(self, product):
+        return msgpack.packb(product, use_bin_type=True)
+
+    def decode_product(self, data):
+        return msgpack.unpackb(data, raw=False)
+
+    def encode_cart(self, cart):
+        return msgpack.packb(cart, use_bin_type=True)
+
+    def decode_cart(self, data):
+        return msgpack.unpackb(data, raw=False)
+
+    def decode_cart_items(self, data):
+        return cart_items(self.decode_cart(data))
+
+
+CODECS = {
+    JsonCodec.name: JsonCodec,
+    ProtobufCodec.name: ProtobufCodec,
+    MsgpackCodec.name: MsgpackCodec,
+}
+
+
+def get_codec(name=None):
+    """Return the codec selected by CACHE_CODEC (protobuf by default)"""
+    name = name or os.getenv("CACHE_CODEC", ProtobufCodec.name)
+    if name not in CODECS:
+        raise ValueError(f"Unknown cache codec: {name}")
+    return CODECS[name]()
+
+
+def cache_key(codec, kind, ident):
+    """Versioned key for an entry, e.g. product:pb1:<id>"""
+    if codec.version is None:
+        return f"{kind}:{ident}"
+    return f"{kind}:{codec.version}:{ident}"
+
+
+def all_cache_keys(kind, ident):
+    """Keys for an entry under every codec, for invalidation"""
+    return [cache_key(codec, kind, ident) for codec in CODECS.values()]
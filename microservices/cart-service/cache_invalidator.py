@@ -0,0 +1,228 @@
+import os
+import time
+import uuid
+import threading
+from collections import deque
+from pymongo.errors import OperationFailure, PyMongoError
+from redis import RedisError
+from cache_codec import all_cache_keys
+
+# Server codes for a resume token that has fallen off the oplog / is unusable
+CHANGE_STREAM_HISTORY_LOST = 286
+INVALID_RESUME_TOKEN = 260
+
+RENEW_LEASE_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("pexpire", KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+
+class CacheInvalidator:
+    """Watch products, carts and users and drop the matching Redis entries"""
+
+    WATCHED_COLLECTIONS = ["products", "carts", "users"]
+
+    # Kept outside the product:/cart: namespaces so cache flushes leave them alone
+    LEASE_KEY = "cache_sync:leader"
+    CART_OWNERS_KEY = "cache_sync:cart_owners"
+
+    def __init__(self, db, redis_client, consumer_name="cart-service"):
+        self.db = db
+        self.redis_client = redis_client
+        self.carts = db["carts"]
+        self.resume_tokens = db["cache_resume_tokens"]
+        self.consumer_name = consumer_name
+        self.instance_id = uuid.uuid4().hex
+        self.lease_ms = int(os.getenv("CACHE_SYNC_LEASE_MS", 15000))
+        self._renew_lease = redis_client.register_script(RENEW_LEASE_SCRIPT)
+        self.pre_images = False
+        self.retry_delay = int(os.getenv("CACHE_SYNC_RETRY_DELAY", 5))
+        self.redelete_delay = float(os.getenv("CACHE_SYNC_REDELETE_DELAY", 2))
+        self._redeletes = deque()
+        self._stop = threading.Event()
+
+    def start(self):
+        """Run the consumer on a daemon thread"""
+        thread = threading.Thread(target=self.run, name="cache-invalidator", daemon=True)
+        thread.start()
+        return thread
+
+    def stop(self):
+        self._stop.set()
+
+    def run(self):
+        self.pre_images = self._enable_pre_images()
+        self._ensure_indexes()
+        while not self._stop.is_set():
+            try:
+                # Only one replica consumes the stream; the others stand by
+                if not self._hold_lease():
+                    self._stop.wait(self.lease_ms / 3000)
+                    continue
+                self._consume()
+            except OperationFailure as e:
+                if e.code in (CHANGE_STREAM_HISTORY_LOST, INVALID_RESUME_TOKEN):
+                    # Events were missed, so nothing cached can be trusted
+                    print(f"Cache invalidator lost its resume point ({e}), flushing cache")
+                    self._clear_resume_token()
+                    self._flush_on_resume_lost()
+                else:
+                    print(f"Cache invalidator error: {e}")
+                    self._stop.wait(self.retry_delay)
+            except (PyMongoError, RedisError) as e:
+                print(f"Cache invalidator error: {e}")
+                self._stop.wait(self.retry_delay)
+            except Exception as e:
+                print(f"Cache invalidator unexpected error: {e}")
+                self._stop.wait(self.retry_delay)
+
+    def _enable_pre_images(self):
+        """Make cart events carry the cart document (MongoDB 6.0+)"""
+        try:
+            self.db.command("collMod", "carts", changeStreamPreAndPostImages={"enabled": True})
+            return True
+        except PyMongoError as e:
+            print(f"Could not enable pre-images on carts, resolving cart owners from the owner map: {e}")
+            return False
+
+    def _ensure_indexes(self):
+        try:
+            self.carts.create_index("items.product_id")
+        except PyMongoError as e:
+            print(f"Could not create carts index on items.product_id: {e}")
+
+    def _hold_lease(self):
+        """Take or renew the consumer lease, True while this replica holds it"""
+        if self._renew_lease(keys=[self.LEASE_KEY], args=[self.instance_id, self.lease_ms]):
+            return True
+        return bool(self.redis_client.set(self.LEASE_KEY, self.instance_id, nx=True, px=self.lease_ms))
+
+    def _flush_on_resume_lost(self):
+        try:
+            self._flush_all()
+        except RedisError as e:
+            # Retried on the next loop; the token is already gone so nothing is skipped
+            print(f"Cache flush failed: {e}")
+            self._stop.wait(self.retry_delay)
+
+    def _consume(self):
+        pipeline = [
+            {"$match": {"ns.coll": {"$in": self.WATCHED_COLLECTIONS}}},
+        ]
+        resume_token = self._load_resume_token()
+        # Images are only requested once carts store them; products need none
+        images = {}
+        if self.pre_images:
+            images = {"full_document": "whenAvailable", "full_document_before_change": "whenAvailable"}
+
+        with self.db.watch(
+            pipeline,
+            resume_after=resume_token,
+            max_await_time_ms=1000,
+            **images,
+        ) as stream:
+            saved_token = resume_token
+            while stream.alive and not self._stop.is_set():
+                if not self._hold_lease():
+                    return
+                change = stream.try_next()
+                if change is not None and change["operationType"] == "invalidate":
+                    # The stream cannot be resumed past an invalidate event
+                    self._clear_resume_token()
+                    self._flush_all()
+                    return
+                if change is not None:
+                    # Raises before the token below is saved if the delete fails
+                    self._handle_change(change)
+                self._run_redeletes()
+                # Save the post-batch token too so idle periods don't go stale
+                if stream.resume_token is not None and stream.resume_token != saved_token:
+                    self._save_resume_token(stream.resume_token)
+                    saved_token = stream.resume_token
+
+    def _handle_change(self, change):
+        operation = change["operationType"]
+        if operation in ("drop", "rename"):
+            self._flush_all()
+            return
+
+        collection = change["ns"]["coll"]
+        document_id = str(change["documentKey"]["_id"])
+
+        if collection == "products":
+            updated_fields = change.get("updateDescription", {}).get("updatedFields", {})
+            price_changed = operation != "update" or "price" in updated_fields
+            self._invalidate_product(document_id, price_changed)
+        elif collection == "carts":
+            self._handle_cart_change(operation, document_id, change)
+        elif collection == "users" and operation == "delete":
+            self._invalidate_cart(document_id)
+
+    def _handle_cart_change(self, operation, cart_id, change):
+        cart = change.get("fullDocument") or change.get("fullDocumentBeforeChange")
+        user_id = cart.get("user_id") if cart else None
+        if user_id:
+            self.redis_client.hset(self.CART_OWNERS_KEY, cart_id, user_id)
+        else:
+            user_id = self.redis_client.hget(self.CART_OWNERS_KEY, cart_id)
+        if not user_id and operation != "delete":
+            # Carts from before the owner map existed, still in Mongo
+            cart = self.carts.find_one({"_id": change["documentKey"]["_id"]}, {"user_id": 1})
+            user_id = cart.get("user_id") if cart else None
+            if user_id:
+                self.redis_client.hset(self.CART_OWNERS_KEY, cart_id, user_id)
+
+        if user_id:
+            self._invalidate_cart(user_id.decode() if isinstance(user_id, bytes) else user_id)
+        else:
+            print(f"Owner of cart {cart_id} unknown, flushing cart keys")
+            self._flush_pattern("cart:*")
+
+        if operation == "delete":
+            self.redis_client.hdel(self.CART_OWNERS_KEY, cart_id)
+
+    def _invalidate_product(self, product_id, price_changed):
+        keys = all_cache_keys("product", product_id)
+        # Cart totals only depend on price, so stock updates skip the carts lookup
+        if price_changed:
+            for cart in self.carts.find({"items.product_id": product_id}, {"user_id": 1}):
+                keys.append(f"cart:total:{cart['user_id']}")
+        self._delete(keys)
+
+    def _invalidate_cart(self, user_id):
+        self._delete(all_cache_keys("cart", user_id) + [f"cart:total:{user_id}"])
+
+    def _delete(self, keys):
+        self.redis_client.delete(*keys)
+        self._redeletes.append((time.monotonic() + self.redelete_delay, keys))
+
+    def _run_redeletes(self):
+        now = time.monotonic()
+        while self._redeletes and self._redeletes[0][0] <= now:
+            self.redis_client.delete(*self._redeletes[0][1])
+            self._redeletes.popleft()
+
+    def _flush_pattern(self, pattern):
+        keys = list(self.redis_client.scan_iter(match=pattern, count=500))
+        if keys:
+            self.redis_client.delete(*keys)
+
+    def _flush_all(self):
+        self._flush_pattern("product:*")
+        self._flush_pattern("cart:*")
+
+    def _load_resume_token(self):
+        state = self.resume_tokens.find_one({"_id": self.consumer_name})
+        return state["token"] if state else None
+
+    def _save_resume_token(self, token):
+        self.resume_tokens.update_one(
+            {"_id": self.consumer_name},
+            {"$set": {"token": token, "updated_at": time.time()}},
+            upsert=True,
+        )
+
+    def _clear_resume_token(self):
+        self.resume_tokens.delete_one({"_id": self.consumer_name})
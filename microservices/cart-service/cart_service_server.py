@@ -1,6 +1,12 @@
 import os
 import grpc
-import json
+import math
+import time
+import uuid
+import random
+import functools
+import threading
+from contextlib import contextmanager
 from concurrent import futures
 from pymongo import MongoClient
 from bson import ObjectId
@@ -8,9 +14,49 @@ import cart_service_pb2
 import cart_service_pb2_grpc
 from dotenv import load_dotenv
 import redis
+from cache_invalidator import CacheInvalidator
+from cache_codec import get_codec, cache_key, all_cache_keys, cart_items
+from redis_batch import RedisBatch
+from single_flight import SingleFlight
 
 load_dotenv()
 
+
+def redis_batched(error_response):
+    """Run an RPC with a request-scoped RedisBatch, reporting flush failures as error_response"""
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, request, context):
+            try:
+                with self._redis_batch():
+                    return method(self, request, context)
+            except redis.RedisError as e:
+                context.set_code(grpc.StatusCode.INTERNAL)
+                context.set_details(str(e))
+                return error_response(str(e))
+        return wrapper
+    return decorator
+
+
+def cart_error(message):
+    return cart_service_pb2.CartResponse(success=False, message=message)
+
+
+def total_price_error(message):
+    return cart_service_pb2.TotalPriceResponse()
+
+
+# Cached in place of a product that does not exist, no codec produces it
+MISSING_PRODUCT = b"-"
+
+RELEASE_LOCK_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
+
 class CartService(cart_service_pb2_grpc.CartServiceServicer):
     def __init__(self):
         self.client = MongoClient(os.getenv("MONGO_URI"))
@@ -22,49 +68,176 @@ class CartService(cart_service_pb2_grpc.CartServiceServicer):
             host=os.getenv("REDIS_HOST", "localhost"),
             port=int(os.getenv("REDIS_PORT", 6380)),
             db=int(os.getenv("REDIS_DB", 0)),
-            password=os.getenv("REDIS_PASSWORD", None),
-            decode_responses=True
+            password=os.getenv("REDIS_PASSWORD", None)
         )
         self.cache_ttl = int(os.getenv("REDIS_CACHE_TTL", 3600))
+        self.cache_codec = get_codec()
+        self._local = threading.local()
+
+        # Miss handling for hot products: one loader per key in this process,
+        # one per key across replicas via a short Redis lock
+        self._single_flight = SingleFlight()
+        self._release_lock = self.redis_client.register_script(RELEASE_LOCK_SCRIPT)
+        self.lock_ttl_ms = int(os.getenv("CACHE_LOCK_TTL_MS", 2000))
+        self.negative_cache_ttl = int(os.getenv("CACHE_NEGATIVE_TTL", 30))
+        # Early refresh: larger beta refreshes hot keys further ahead of expiry
+        self.refresh_beta = float(os.getenv("CACHE_REFRESH_BETA", 1.0))
+        self._fetch_seconds = 0.05
+        self._refresh_executor = futures.ThreadPoolExecutor(max_workers=2)
+
+    @contextmanager
+    def _redis_batch(self):
+        """Route cache calls on this thread through one batch until the block exits"""
+        if getattr(self._local, "batch", None) is not None:
+            yield self._local.batch
+            return
+        batch = RedisBatch(self.redis_client)
+        self._local.batch = batch
+        try:
+            yield batch
+        finally:
+            self._local.batch = None
+            batch.flush()
+
+    def _cache(self):
+        """The current request's batch, or the plain client outside of one"""
+        return getattr(self._local, "batch", None) or self.redis_client
+
+    def _prefetch(self, *keys):
+        batch = getattr(self._local, "batch", None)
+        if batch is not None:
+            batch.prefetch(keys)
+
+    def _product_key(self, product_id):
+        return cache_key(self.cache_codec, "product", product_id)
+
+    def _cart_key(self, user_id):
+        return cache_key(self.cache_codec, "cart", user_id)
+
+    def _cache_get_with_ttl(self, key):
+        batch = getattr(self._local, "batch", None)
+        if batch is not None:
+            return batch.get_with_ttl(key)
+        pipe = self.redis_client.pipeline(transaction=False)
+        pipe.get(key)
+        pipe.pttl(key)
+        return tuple(pipe.execute())
 
     def _get_product(self, product_id):
         """Get product from cache or database"""
-        cache_key = f"product:{product_id}"
-        cached_product = self.redis_client.get(cache_key)
+        key = self._product_key(product_id)
+        cached_product, ttl_ms = self._cache_get_with_ttl(key)
         
         if cached_product:
-            return json.loads(cached_product)
+            if self._should_refresh_early(ttl_ms) and not self._single_flight.in_flight(key):
+                self._refresh_executor.submit(self._refresh_product, product_id)
+            return self._decode_product(cached_product)
         
+        # Shared with concurrent callers; each records the value in its own request batch
+        product, encoded, ttl_ms = self._single_flight.do(key, lambda: self._load_product(product_id))
+        batch = getattr(self._local, "batch", None)
+        if batch is not None:
+            batch.remember(key, encoded, ttl_ms / 1000)
+        return product
+
+    def _decode_product(self, cached_product):
+        if cached_product == MISSING_PRODUCT:
+            return None
+        return self.cache_codec.decode_product(cached_product)
+
+    def _should_refresh_early(self, ttl_ms):
+        """Probabilistic early expiry (XFetch): more likely as the TTL runs out"""
+        if ttl_ms is None or ttl_ms < 0:
+            return False
+        return self._fetch_seconds * self.refresh_beta * -math.log(1.0 - random.random()) >= ttl_ms / 1000
+
+    def _load_product(self, product_id):
+        """Cache miss: (product, cached bytes, TTL in ms) from Mongo or the replica holding the lock"""
+        key = self._product_key(product_id)
+        lock_key = f"lock:{key}"
+        token = uuid.uuid4().hex
+        deadline = time.monotonic() + self.lock_ttl_ms / 1000
+
+        while True:
+            if self.redis_client.set(lock_key, token, nx=True, px=self.lock_ttl_ms):
+                try:
+                    return self._fetch_product(product_id)
+                finally:
+                    self._release_lock(keys=[lock_key], args=[token])
+
+            locked = True
+            while locked:
+                if time.monotonic() >= deadline:
+                    return self._fetch_product(product_id)
+                time.sleep(0.025)
+                pipe = self.redis_client.pipeline(transaction=False)
+                pipe.get(key)
+                pipe.pttl(key)
+                pipe.exists(lock_key)
+                cached_product, ttl_ms, locked = pipe.execute()
+                if cached_product:
+                    return self._decode_product(cached_product), cached_product, ttl_ms
+
+    def _refresh_product(self, product_id):
+        """Background refresh of a hit that is close to expiring"""
+        key = self._product_key(product_id)
+        lock_key = f"lock:{key}"
+        token = uuid.uuid4().hex
+
+        try:
+            if not self.redis_client.set(lock_key, token, nx=True, px=self.lock_ttl_ms):
+                return
+            try:
+                self._single_flight.do(key, lambda: self._fetch_product(product_id))
+            finally:
+                self._release_lock(keys=[lock_key], args=[token])
+        except Exception as e:
+            print(f"Failed to refresh {key}: {e}")
+
+    def _fetch_product(self, product_id):
+        key = self._product_key(product_id)
+        started = time.monotonic()
         product = self.products.find_one({"_id": ObjectId(product_id)})
+        self._fetch_seconds = 0.8 * self._fetch_seconds + 0.2 * (time.monotonic() - started)
+
         if product:
             product['_id'] = str(product['_id'])
-            self.redis_client.setex(cache_key, self.cache_ttl, json.dumps(product))
-        
-        return product
+            encoded, ttl = self.cache_codec.encode_product(product), self.cache_ttl
+        else:
+            encoded, ttl = MISSING_PRODUCT, self.negative_cache_ttl
+
+        # Written straight through so other waiters and replicas see it now
+        self.redis_client.setex(key, ttl, encoded)
+        return product, encoded, ttl * 1000
 
     def _get_cart(self, user_id):
         """Get cart from cache or database"""
-        cache_key = f"cart:{user_id}"
-        cached_cart = self.redis_client.get(cache_key)
+        key = self._cart_key(user_id)
+        cached_cart = self._cache().get(key)
         
         if cached_cart:
-            return json.loads(cached_cart)
+            return self.cache_codec.decode_cart(cached_cart)
         
+        return self._load_cart(user_id)
+
+    def _load_cart(self, user_id):
+        key = self._cart_key(user_id)
         cart = self.carts.find_one({"user_id": user_id})
         if cart:
             cart['_id'] = str(cart['_id'])
-            self.redis_client.setex(cache_key, self.cache_ttl, json.dumps(cart))
+            self._cache().setex(key, self.cache_ttl, self.cache_codec.encode_cart(cart))
         
         return cart
 
     def _invalidate_cart_cache(self, user_id):
         """Invalidate cart cache for a user"""
-        self.redis_client.delete(f"cart:{user_id}")
+        self._cache().delete(*all_cache_keys("cart", user_id), f"cart:total:{user_id}")
 
     def _invalidate_product_cache(self, product_id):
         """Invalidate product cache"""
-        self.redis_client.delete(f"product:{product_id}")
+        self._cache().delete(*all_cache_keys("product", product_id))
 
+    @redis_batched(cart_error)
     def AddToCart(self, request, context):
         try:
             user_id = request.user_id
@@ -97,6 +270,7 @@ class CartService(cart_service_pb2_grpc.CartServiceServicer):
             context.set_details(str(e))
             return cart_service_pb2.CartResponse(success=False, message=str(e))
 
+    @redis_batched(cart_error)
     def RemoveFromCart(self, request, context):
         try:
             user_id = request.user_id
@@ -124,12 +298,15 @@ class CartService(cart_service_pb2_grpc.CartServiceServicer):
             context.set_details(str(e))
             return cart_service_pb2.CartResponse(success=False, message=str(e))
 
+    @redis_batched(cart_error)
     def UpdateCartItem(self, request, context):
         try:
             user_id = request.user_id
             product_id = request.product_id
             new_quantity = request.quantity
 
+            self._prefetch(self._cart_key(user_id), self._product_key(product_id))
+
             cart = self._get_cart(user_id)
             if not cart:
                 return cart_service_pb2.CartResponse(success=False, message="Cart not found")
@@ -162,14 +339,20 @@ class CartService(cart_service_pb2_grpc.CartServiceServicer):
             return cart_service_pb2.CartResponse(success=False, message=str(e))
 
     def GetCartItems(self, request, context):
-        cart = self._get_cart(request.user_id)
+        cached_cart = self._cache().get(self._cart_key(request.user_id))
+        if cached_cart:
+            # Decoded straight into CartItem messages, no dict round trip
+            return cart_service_pb2.GetCartItemsResponse(items=self.cache_codec.decode_cart_items(cached_cart))
+
+        cart = self._load_cart(request.user_id)
         if not cart:
             return cart_service_pb2.GetCartItemsResponse(items=[])
 
         return cart_service_pb2.GetCartItemsResponse(
-            items=[cart_service_pb2.CartItem(product_id=item["product_id"], quantity=item["quantity"]) for item in cart["items"]]
+            items=cart_items(cart)
         )
 
+    @redis_batched(cart_error)
     def ClearCart(self, request, context):
         try:
             user_id = request.user_id
@@ -193,9 +376,11 @@ class CartService(cart_service_pb2_grpc.CartServiceServicer):
             context.set_details(str(e))
             return cart_service_pb2.CartResponse(success=False, message=str(e))
 
+    @redis_batched(total_price_error)
     def CalculateTotalPrice(self, request, context):
-        cache_key = f"cart:total:{request.user_id}"
-        cached_total = self.redis_client.get(cache_key)
+        total_key = f"cart:total:{request.user_id}"
+        self._prefetch(total_key, self._cart_key(request.user_id))
+        cached_total = self._cache().get(total_key)
         
         if cached_total:
             return cart_service_pb2.TotalPriceResponse(total_price=float(cached_total))
@@ -204,20 +389,27 @@ class CartService(cart_service_pb2_grpc.CartServiceServicer):
         if not cart:
             return cart_service_pb2.TotalPriceResponse(total_price=0)
 
+        self._prefetch(*[self._product_key(item["product_id"]) for item in cart["items"]])
+
         total_price = 0
         for item in cart["items"]:
             product = self._get_product(item["product_id"])
             if product:
                 total_price += product["price"] * item["quantity"]
         
-        self.redis_client.setex(cache_key, self.cache_ttl, str(total_price))
+        self._cache().setex(total_key, self.cache_ttl, str(total_price))
 
         return cart_service_pb2.TotalPriceResponse(total_price=total_price)
 
 
 def serve():
     server = grpc.server(futures.ThreadPoolExecutor(max_workers=10))
-    cart_service_pb2_grpc.add_CartServiceServicer_to_server(CartService(), server)
+    cart_service = CartService()
+    cart_service_pb2_grpc.add_CartServiceServicer_to_server(cart_service, server)
+
+    if os.getenv("CACHE_SYNC_ENABLED", "true").lower() == "true":
+        CacheInvalidator(cart_service.db, cart_service.redis_client).start()
+
     server.add_insecure_port("[::]:50053")
     server.start()
     print("Cart Service Server with Redis Cache started on port 50053")
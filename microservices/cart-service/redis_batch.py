@@ -0,0 +1,59 @@
+_DELETE = object()
+
+
+class RedisBatch:
+    """Collects the Redis reads and writes of one RPC into as few round trips as possible"""
+
+    def __init__(self, redis_client, transaction=True):
+        self.redis_client = redis_client
+        self.transaction = transaction
+        self._reads = {}
+        self._writes = {}
+
+    def prefetch(self, keys):
+        """Load several keys and their TTLs in one round trip"""
+        keys = [key for key in dict.fromkeys(keys) if key not in self._reads and key not in self._writes]
+        if not keys:
+            return
+        pipe = self.redis_client.pipeline(transaction=False)
+        for key in keys:
+            pipe.get(key)
+            pipe.pttl(key)
+        results = pipe.execute()
+        for i, key in enumerate(keys):
+            self._reads[key] = (results[2 * i], results[2 * i + 1])
+
+    def get(self, key):
+        return self.get_with_ttl(key)[0]
+
+    def get_with_ttl(self, key):
+        """Return (value, remaining TTL in ms) as seen by this request"""
+        if key in self._writes:
+            write = self._writes[key]
+            return (None, -2) if write is _DELETE else (write[1], write[0] * 1000)
+        if key not in self._reads:
+            self.prefetch([key])
+        return self._reads[key]
+
+    def remember(self, key, value, ttl):
+        """Record a value written to Redis outside the batch"""
+        self._reads[key] = (value, ttl * 1000)
+
+    def setex(self, key, ttl, value):
+        self._writes[key] = (ttl, value)
+
+    def delete(self, *keys):
+        for key in keys:
+            self._writes[key] = _DELETE
+
+    def flush(self):
+        if not self._writes:
+            return
+        pipe = self.redis_client.pipeline(transaction=self.transaction)
+        for key, write in self._writes.items():
+            if write is _DELETE:
+                pipe.delete(key)
+            else:
+                pipe.setex(key, *write)
+        pipe.execute()
+        self._writes.clear()
@@ -1,8 +1,10 @@
 import os
+import sys
 import grpc
 from concurrent import futures
-from datetime import datetime
-from pymongo import MongoClient
+from datetime import datetime, timedelta, timezone
+from pymongo import MongoClient, ReadPreference, ReturnDocument
+from pymongo.errors import PyMongoError
 from bson import ObjectId
 import order_service_pb2
 import order_service_pb2_grpc
@@ -10,6 +12,19 @@ from dotenv import load_dotenv
 
 load_dotenv()
 
+
+def status_field(status):
+    """Escape a status for use as a rollup field name ('.' and '$' are path syntax)"""
+    return status.replace("%", "%25").replace(".", "%2E").replace("$", "%24")
+
+
+def status_from_field(field):
+    return field.replace("%24", "$").replace("%2E", ".").replace("%25", "%")
+
+
+# Orders that count towards revenue, product sales and lifetime value
+ACTIVE_ORDER = {"$ne": ["$status", "cancelled"]}
+
 class OrderService(order_service_pb2_grpc.OrderServiceServicer):
     def __init__(self):
         self.client = MongoClient(os.getenv("MONGO_URI"))
@@ -18,6 +33,214 @@ class OrderService(order_service_pb2_grpc.OrderServiceServicer):
         self.carts = self.db["carts"]
         self.products = self.db["products"]
 
+        # Rollups are maintained on every order write; reads of them may be
+        # served by secondaries so dashboards stay off the primary
+        self.rollups_hourly = self.db.get_collection(
+            "order_rollups_hourly", read_preference=ReadPreference.SECONDARY_PREFERRED)
+        self.rollups_daily = self.db.get_collection(
+            "order_rollups_daily", read_preference=ReadPreference.SECONDARY_PREFERRED)
+        self.user_ltv = self.db.get_collection(
+            "order_user_ltv", read_preference=ReadPreference.SECONDARY_PREFERRED)
+        # Which buckets and users each order write touched, for rebuild_rollups
+        self.rollup_changes = self.db["order_rollup_changes"]
+        self.rollup_changes.create_index("at", expireAfterSeconds=86400)
+
+    def _update_rollups(self, order, sign=0, old_status=None, new_status=None):
+        """Add (sign=1) or remove (sign=-1) an order and move it between status counters"""
+        if not order.get("rolled_up"):
+            # Created before rollups existed and not backfilled yet: nothing to adjust
+            return
+
+        inc = {}
+        if sign:
+            inc["revenue"] = sign * order["total_price"]
+            inc["order_count"] = sign
+            for item in order["items"]:
+                field = f"products.{item['product_id']}"
+                inc[field] = inc.get(field, 0) + sign * item["quantity"]
+        if old_status:
+            inc[f"statuses.{status_field(old_status)}"] = -1
+        if new_status:
+            field = f"statuses.{status_field(new_status)}"
+            inc[field] = inc.get(field, 0) + 1
+        if not inc:
+            return
+
+        created_at = order["created_at"]
+        hour = created_at.replace(minute=0, second=0, microsecond=0)
+        try:
+            self.rollups_hourly.update_one({"_id": hour}, {"$inc": inc}, upsert=True)
+            self.rollups_daily.update_one({"_id": hour.replace(hour=0)}, {"$inc": inc}, upsert=True)
+            if sign:
+                self.user_ltv.update_one(
+                    {"_id": order["user_id"]},
+                    {
+                        "$inc": {"total_spent": sign * order["total_price"], "order_count": sign},
+                        "$min": {"first_order_at": created_at},
+                        "$max": {"last_order_at": created_at},
+                    },
+                    upsert=True,
+                )
+            self.rollup_changes.insert_one({"hour": hour, "user_id": order["user_id"], "at": datetime.utcnow()})
+        except PyMongoError as e:
+            # The order itself is written; rebuild_rollups() repairs any drift
+            print(f"Failed to update rollups for order {order['_id']}: {e}")
+
+    def _update_rollups_for_status_change(self, order, new_status):
+        old_status = order["status"]
+        sign = 0
+        if new_status == "cancelled" and old_status != "cancelled":
+            sign = -1
+        elif old_status == "cancelled" and new_status != "cancelled":
+            sign = 1
+        self._update_rollups(order, sign=sign, old_status=old_status, new_status=new_status)
+
+    def rebuild_rollups(self):
+        """Recompute the rollups from the orders collection while the service keeps running"""
+        started = datetime.utcnow()
+        hour_cutoff = started.replace(minute=0, second=0, microsecond=0)
+        day_cutoff = hour_cutoff.replace(hour=0)
+
+        self.orders.create_index("created_at")
+        # From here on, changes to backfilled orders adjust the rollups too
+        self.orders.update_many({"rolled_up": {"$ne": True}}, {"$set": {"rolled_up": True}})
+
+        # The current hour/day keep their live counters; older buckets are replaced
+        self._rebuild_buckets(self.rollups_hourly, "hour", {"created_at": {"$lt": hour_cutoff}},
+                              {"_id": {"$lt": hour_cutoff}})
+        self._rebuild_buckets(self.rollups_daily, "day", {"created_at": {"$lt": day_cutoff}},
+                              {"_id": {"$lt": day_cutoff}})
+        self._rebuild_user_ltv({}, {})
+
+        # Redo what live order writes touched while the aggregations ran
+        hours, users = set(), set()
+        for change in self.rollup_changes.find({"at": {"$gte": started}}):
+            hours.add(change["hour"])
+            users.add(change["user_id"])
+        hours = sorted(hour for hour in hours if hour < hour_cutoff)
+        days = sorted({hour.replace(hour=0) for hour in hours if hour < day_cutoff})
+        if hours:
+            self._rebuild_buckets(self.rollups_hourly, "hour", self._created_in(hours, timedelta(hours=1)),
+                                  {"_id": {"$in": hours}})
+        if days:
+            self._rebuild_buckets(self.rollups_daily, "day", self._created_in(days, timedelta(days=1)),
+                                  {"_id": {"$in": days}})
+        if users:
+            self._rebuild_user_ltv({"user_id": {"$in": list(users)}}, {"_id": {"$in": list(users)}})
+
+    def _created_in(self, buckets, width):
+        return {"$or": [{"created_at": {"$gte": bucket, "$lt": bucket + width}} for bucket in buckets]}
+
+    def _rebuild_buckets(self, rollups, unit, order_filter, bucket_filter):
+        """Aggregate matching orders into a staging collection, then replace those buckets in place"""
+        staging = self.db[f"{rollups.name}_rebuild"]
+        for pipeline in self._rollup_pipelines(unit, staging.name):
+            self.orders.aggregate([{"$match": order_filter}] + pipeline)
+        self._replace_from(staging, rollups, bucket_filter)
+
+    def _rebuild_user_ltv(self, order_filter, user_filter):
+        staging = self.db[f"{self.user_ltv.name}_rebuild"]
+        self.orders.aggregate([
+            {"$match": order_filter},
+            {"$group": {
+                "_id": "$user_id",
+                "total_spent": {"$sum": {"$cond": [ACTIVE_ORDER, "$total_price", 0]}},
+                "order_count": {"$sum": {"$cond": [ACTIVE_ORDER, 1, 0]}},
+                "first_order_at": {"$min": "$created_at"},
+                "last_order_at": {"$max": "$created_at"},
+            }},
+            {"$out": staging.name},
+        ])
+        self._replace_from(staging, self.user_ltv, user_filter)
+
+    def _replace_from(self, staging, collection, scope):
+        """Upsert every staged document into collection and drop scoped ones that no longer exist"""
+        staging.aggregate([
+            {"$merge": {"into": collection.name, "on": "_id", "whenMatched": "replace", "whenNotMatched": "insert"}},
+        ])
+        collection.delete_many({"$and": [scope, {"_id": {"$nin": staging.distinct("_id")}}]})
+        staging.drop()
+
+    def _rollup_pipelines(self, unit, target):
+        """Pipelines that build bucket documents like _update_rollups does, in order"""
+        bucket = {"$dateTrunc": {"date": "$created_at", "unit": unit}}
+        merge = {"$merge": {"into": target, "on": "_id", "whenMatched": "merge", "whenNotMatched": "insert"}}
+        escaped_status = "$_id.status"
+        for find, replacement in (("%", "%25"), (".", "%2E"), ({"$literal": "$"}, "%24")):
+            escaped_status = {"$replaceAll": {"input": escaped_status, "find": find, "replacement": replacement}}
+
+        totals = [
+            {"$group": {
+                "_id": bucket,
+                "revenue": {"$sum": {"$cond": [ACTIVE_ORDER, "$total_price", 0]}},
+                "order_count": {"$sum": {"$cond": [ACTIVE_ORDER, 1, 0]}},
+            }},
+            {"$out": target},
+        ]
+        statuses = [
+            {"$match": {"status": {"$nin": ["", None]}}},
+            {"$group": {"_id": {"bucket": bucket, "status": "$status"}, "count": {"$sum": 1}}},
+            {"$group": {"_id": "$_id.bucket", "statuses": {"$push": {"k": escaped_status, "v": "$count"}}}},
+            {"$project": {"statuses": {"$arrayToObject": "$statuses"}}},
+            merge,
+        ]
+        products = [
+            {"$match": {"status": {"$ne": "cancelled"}}},
+            {"$unwind": "$items"},
+            {"$group": {
+                "_id": {"bucket": bucket, "product_id": "$items.product_id"},
+                "quantity": {"$sum": "$items.quantity"},
+            }},
+            {"$group": {"_id": "$_id.bucket", "products": {"$push": {"k": "$_id.product_id", "v": "$quantity"}}}},
+            {"$project": {"products": {"$arrayToObject": "$products"}}},
+            merge,
+        ]
+        return [totals, statuses, products]
+
+    def _parse_time(self, value, default):
+        if not value:
+            return default
+        try:
+            parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+        except ValueError:
+            raise ValueError(f"Invalid time: {value!r}, expected ISO 8601")
+        if parsed.tzinfo is not None:
+            parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+        return parsed
+
+    def _bucket_query(self, request, granularity):
+        """Pick the rollup collection and _id filter for a request's time window"""
+        start = self._parse_time(request.start_time, datetime.min)
+        end = self._parse_time(request.end_time, datetime.utcnow())
+
+        if granularity == "hour":
+            start = start.replace(minute=0, second=0, microsecond=0)
+            return self.rollups_hourly, {"_id": {"$gte": start, "$lt": end}}
+        start = start.replace(hour=0, minute=0, second=0, microsecond=0)
+        return self.rollups_daily, {"_id": {"$gte": start, "$lt": end}}
+
+    def _window_stages(self, request):
+        """Collection and $match stages covering a window: daily buckets for whole days, hourly at the edges"""
+        start = self._parse_time(request.start_time, datetime.min).replace(minute=0, second=0, microsecond=0)
+        end = self._parse_time(request.end_time, datetime.utcnow())
+
+        first_day = start.replace(hour=0)
+        if first_day < start:
+            first_day += timedelta(days=1)
+        last_day = end.replace(hour=0, minute=0, second=0, microsecond=0)
+
+        if first_day >= last_day:
+            return self.rollups_hourly, [{"$match": {"_id": {"$gte": start, "$lt": end}}}]
+        return self.rollups_daily, [
+            {"$match": {"_id": {"$gte": first_day, "$lt": last_day}}},
+            {"$unionWith": {"coll": self.rollups_hourly.name, "pipeline": [
+                {"$match": {"$or": [
+                    {"_id": {"$gte": start, "$lt": first_day}},
+                    {"_id": {"$gte": last_day, "$lt": end}},
+                ]}},
+            ]}},
+        ]
+
     def CreateOrder(self, request, context):
         try:
             user_id = request.user_id
@@ -45,11 +268,13 @@ class OrderService(order_service_pb2_grpc.OrderServiceServicer):
                 "items": items,
                 "total_price": total_price,
                 "status": "pending",
-                "created_at": datetime.utcnow()
+                "created_at": datetime.utcnow(),
+                "rolled_up": True
             }
 
             inserted = self.orders.insert_one(order_doc)
             self.carts.delete_one({"user_id": user_id})  # Clear cart after order
+            self._update_rollups(order_doc, sign=1, new_status=order_doc["status"])
 
             return order_service_pb2.CreateOrderResponse(message="Order created", order_id=str(inserted.inserted_id))
 
@@ -106,11 +331,13 @@ class OrderService(order_service_pb2_grpc.OrderServiceServicer):
 
     def CancelOrder(self, request, context):
         try:
-            result = self.orders.update_one(
-                {"_id": ObjectId(request.order_id)},
-                {"$set": {"status": "cancelled"}}
+            order = self.orders.find_one_and_update(
+                {"_id": ObjectId(request.order_id), "status": {"$ne": "cancelled"}},
+                {"$set": {"status": "cancelled"}},
+                return_document=ReturnDocument.BEFORE
             )
-            if result.modified_count == 1:
+            if order:
+                self._update_rollups_for_status_change(order, "cancelled")
                 return order_service_pb2.GenericResponse(message="Order cancelled")
             return order_service_pb2.GenericResponse(message="Order not found or already cancelled")
         except Exception as e:
@@ -120,11 +347,18 @@ class OrderService(order_service_pb2_grpc.OrderServiceServicer):
 
     def UpdateOrderStatus(self, request, context):
         try:
-            result = self.orders.update_one(
-                {"_id": ObjectId(request.order_id)},
-                {"$set": {"status": request.status}}
+            if not request.status.strip():
+                context.set_code(grpc.StatusCode.INVALID_ARGUMENT)
+                context.set_details("Status is required")
+                return order_service_pb2.GenericResponse(message="Status is required")
+
+            order = self.orders.find_one_and_update(
+                {"_id": ObjectId(request.order_id), "status": {"$ne": request.status}},
+                {"$set": {"status": request.status}},
+                return_document=ReturnDocument.BEFORE
             )
-            if result.modified_count == 1:
+            if order:
+                self._update_rollups_for_status_change(order, request.status)
                 return order_service_pb2.GenericResponse(message="Order status updated")
             return order_service_pb2.GenericResponse(message="Order not found")
         except Exception as e:
@@ -134,8 +368,10 @@ class OrderService(order_service_pb2_grpc.OrderServiceServicer):
 
     def DeleteOrder(self, request, context):
         try:
-            result = self.orders.delete_one({"_id": ObjectId(request.order_id)})
-            if result.deleted_count == 1:
+            order = self.orders.find_one_and_delete({"_id": ObjectId(request.order_id)})
+            if order:
+                sign = 0 if order["status"] == "cancelled" else -1
+                self._update_rollups(order, sign=sign, old_status=order["status"])
                 return order_service_pb2.GenericResponse(message="Order deleted")
             return order_service_pb2.GenericResponse(message="Order not found")
         except Exception as e:
@@ -143,6 +379,106 @@ class OrderService(order_service_pb2_grpc.OrderServiceServicer):
             context.set_details(str(e))
             return order_service_pb2.GenericResponse(message="Internal error")
 
+    def GetRevenue(self, request, context):
+        try:
+            granularity = "hour" if request.granularity == "hour" else "day"
+            rollups, query = self._bucket_query(request, granularity)
+
+            buckets = []
+            total_revenue = 0
+            order_count = 0
+            for bucket in rollups.find(query, {"revenue": 1, "order_count": 1}).sort("_id", 1):
+                total_revenue += bucket.get("revenue", 0)
+                order_count += bucket.get("order_count", 0)
+                buckets.append(order_service_pb2.RevenueBucket(
+                    bucket_start=str(bucket["_id"]),
+                    revenue=bucket.get("revenue", 0),
+                    order_count=bucket.get("order_count", 0)
+                ))
+
+            return order_service_pb2.RevenueResponse(
+                total_revenue=total_revenue, order_count=order_count, buckets=buckets)
+
+        except ValueError as e:
+            context.set_code(grpc.StatusCode.INVALID_ARGUMENT)
+            context.set_details(str(e))
+            return order_service_pb2.RevenueResponse()
+        except Exception as e:
+            context.set_code(grpc.StatusCode.INTERNAL)
+            context.set_details(str(e))
+            return order_service_pb2.RevenueResponse()
+
+    def GetOrderCountsByStatus(self, request, context):
+        try:
+            rollups, window = self._window_stages(request)
+            pipeline = window + [
+                {"$project": {"statuses": {"$objectToArray": "$statuses"}}},
+                {"$unwind": "$statuses"},
+                {"$group": {"_id": "$statuses.k", "count": {"$sum": "$statuses.v"}}},
+                {"$match": {"count": {"$gt": 0}}},
+                {"$sort": {"_id": 1}},
+            ]
+
+            return order_service_pb2.OrderStatusCounts(counts=[
+                order_service_pb2.StatusCount(status=status_from_field(row["_id"]), count=row["count"])
+                for row in rollups.aggregate(pipeline)
+            ])
+
+        except ValueError as e:
+            context.set_code(grpc.StatusCode.INVALID_ARGUMENT)
+            context.set_details(str(e))
+            return order_service_pb2.OrderStatusCounts()
+        except Exception as e:
+            context.set_code(grpc.StatusCode.INTERNAL)
+            context.set_details(str(e))
+            return order_service_pb2.OrderStatusCounts()
+
+    def GetTopProducts(self, request, context):
+        try:
+            rollups, window = self._window_stages(request)
+            limit = request.limit if request.limit > 0 else 10
+            pipeline = window + [
+                {"$project": {"products": {"$objectToArray": "$products"}}},
+                {"$unwind": "$products"},
+                {"$group": {"_id": "$products.k", "quantity": {"$sum": "$products.v"}}},
+                {"$match": {"quantity": {"$gt": 0}}},
+                {"$sort": {"quantity": -1, "_id": 1}},
+                {"$limit": limit},
+            ]
+
+            return order_service_pb2.TopProductsResponse(products=[
+                order_service_pb2.ProductSales(product_id=row["_id"], quantity=row["quantity"])
+                for row in rollups.aggregate(pipeline)
+            ])
+
+        except ValueError as e:
+            context.set_code(grpc.StatusCode.INVALID_ARGUMENT)
+            context.set_details(str(e))
+            return order_service_pb2.TopProductsResponse()
+        except Exception as e:
+            context.set_code(grpc.StatusCode.INTERNAL)
+            context.set_details(str(e))
+            return order_service_pb2.TopProductsResponse()
+
+    def GetUserLifetimeValue(self, request, context):
+        try:
+            ltv = self.user_ltv.find_one({"_id": request.user_id})
+            if not ltv:
+                return order_service_pb2.UserLifetimeValue(user_id=request.user_id)
+
+            return order_service_pb2.UserLifetimeValue(
+                user_id=request.user_id,
+                total_spent=ltv["total_spent"],
+                order_count=ltv["order_count"],
+                first_order_at=str(ltv["first_order_at"]),
+                last_order_at=str(ltv["last_order_at"])
+            )
+
+        except Exception as e:
+            context.set_code(grpc.StatusCode.INTERNAL)
+            context.set_details(str(e))
+            return order_service_pb2.UserLifetimeValue()
+
 
 def serve():
     server = grpc.server(futures.ThreadPoolExecutor(max_workers=10))
@@ -154,4 +490,8 @@ def serve():
 
 
 if __name__ == "__main__":
-    serve()
+    if "--rebuild-rollups" in sys.argv:
+        OrderService().rebuild_rollups()
+        print("Order rollups rebuilt")
+    else:
+        serve()